@@ -138,6 +138,9 @@ class Stats:
     """A set of important statistic values, with simple access and printing."""
 
     def __init__(self, data):
+        if not data:  # nothing evaluated, avoid errors on empty data
+            self.mean = self.median = self.min = self.max = self.perc25 = self.perc75 = 0.0
+            return
         self.mean = np.mean(data)
         self.median = np.median(data)
         self.min = min(data)
@@ -279,6 +282,8 @@ class Evaluator(object):
     def tree_accuracy(self):
         """Return tree-level accuracy (percentage of gold trees scored higher or equal to
         the best predicted tree."""
+        if not self.scores:
+            return 0.0
         return (sum(1 for gold_score, pred_score in self.scores if gold_score >= pred_score) /
                 float(len(self.scores)))
 
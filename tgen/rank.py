@@ -10,12 +10,14 @@ import numpy as np
 import cPickle as pickle
 import time
 import datetime
-from collections import defaultdict, namedtuple
+import copy
+import multiprocessing
+from collections import defaultdict, namedtuple, OrderedDict
 
 from pytreex.core.util import file_stream
 
 from ml import DictVectorizer, StandardScaler
-from logf import log_info, log_debug
+from logf import log_info, log_debug, is_debug_stream
 from features import Features
 from futil import read_das, read_ttrees, trees_from_doc, sentences_from_doc
 from planner import ASearchPlanner
@@ -26,6 +28,22 @@ from tgen.eval import ASearchListsAnalyzer
 from tgen.rnd import rnd
 
 
+# Features object used by feature extraction worker processes (set up by _init_feats_worker)
+_worker_feats = None
+
+
+def _init_feats_worker(feats):
+    """Initialize a feature extraction worker process with the given Features object."""
+    global _worker_feats
+    _worker_feats = feats
+
+
+def _get_inst_feats(inst):
+    """Return (unvectorized) features for a (tree, DA) pair; run in a worker process."""
+    tree, da = inst
+    return _worker_feats.get_features(tree, {'da': da})
+
+
 class Inst(namedtuple('Inst', ['tree', 'da', 'feats', 'score'])):
     """A holder for one data instance (input tree, output DA, extracted features, ranker score)."""
     pass
@@ -50,11 +68,21 @@ class Ranker(object):
 
 class BasePerceptronRanker(Ranker):
 
+    # members only needed in training, not stored with the trained model
+    TRAINING_ONLY_MEMBERS = ['train_trees', 'train_das', 'train_sents', 'train_order',
+                             'train_feats', 'asearch_planner', 'evaluator', 'lists_analyzer',
+                             'w_after_iter', 'w_iter_sum', 'w_iter_count', '_w_delta', '_diff_buf']
+
     def __init__(self, cfg):
         if not cfg:
             cfg = {}
         self.passes = cfg.get('passes', 5)
         self.alpha = cfg.get('alpha', 1)
+        # number of training examples over which weight updates are accumulated
+        # (updates made during 'gen_update' search are always applied immediately)
+        self.batch_size = cfg.get('batch_size', 1)
+        if self.batch_size < 1:
+            raise ValueError('Batch size must be at least 1 (got %d)!' % self.batch_size)
         self.language = cfg.get('language', 'en')
         self.selector = cfg.get('selector', '')
         # initialize diagnostics
@@ -73,6 +101,31 @@ class BasePerceptronRanker(Ranker):
         self.rival_gen_prune_size = cfg.get('rival_gen_prune_size')
         self.candgen_model = cfg.get('candgen_model')
         self.diffing_trees = cfg.get('diffing_trees', False)
+        # number of 'other_inst'/'other_da' rival feature vectors kept over training passes
+        # (see _get_train_inst_feats; 0 = extract the features anew each time, the default)
+        self.train_inst_feats_cache_size = cfg.get('train_inst_feats_cache_size', 0)
+
+    def __getstate__(self):
+        """Leave out feature caches when pickling (they are rebuilt on demand)."""
+        state = self.__dict__.copy()
+        if '_train_inst_feats' in state:
+            state['_train_inst_feats'] = OrderedDict()
+        if '_feats_cache' in state:
+            state['_feats_cache'] = OrderedDict()
+        return state
+
+    def save_to_file(self, model_fname):
+        """Save the model to a file, leaving out training data and other members only needed
+        in training."""
+        super(BasePerceptronRanker, self._get_model_to_save()).save_to_file(model_fname)
+
+    def _get_model_to_save(self):
+        """Return a shallow copy of the ranker without members only needed in training."""
+        model = copy.copy(self)
+        for member in self.TRAINING_ONLY_MEMBERS:
+            if member in model.__dict__:
+                delattr(model, member)
+        return model
 
     def score(self, cand_tree, da):
         """Score the given tree in the context of the given dialogue act.
@@ -88,6 +141,21 @@ class BasePerceptronRanker(Ranker):
     def _extract_feats(self, tree, da):
         raise NotImplementedError
 
+    def _extract_feats_nocache(self, tree, da):
+        """Return features for the given tree and DA, bypassing any feature caches. To be
+        overridden by derived classes that cache features."""
+        return self._extract_feats(tree, da)
+
+    def _score_batch(self, cands_feats):
+        """Score a batch of candidates, given their features. May be overridden in derived
+        classes to score all candidates at once.
+
+        @param cands_feats: a list of candidate features
+        @rtype: np.ndarray
+        @return: an array of candidate scores
+        """
+        return np.array([self._score(cand_feats) for cand_feats in cands_feats])
+
     def train(self, das_file, ttree_file, data_portion=1.0):
         """Run training on the given training data."""
         self._init_training(das_file, ttree_file, data_portion)
@@ -121,6 +189,8 @@ class BasePerceptronRanker(Ranker):
         self.train_sents = sents[:train_size]
         self.train_order = range(len(self.train_trees))
         log_info('Using %d training instances.' % train_size)
+        # LRU cache for features of training trees combined with training DAs (kept over passes)
+        self._train_inst_feats = OrderedDict()
 
         # initialize candidate generator
         if self.candgen_model is not None:
@@ -161,10 +231,11 @@ class BasePerceptronRanker(Ranker):
         rgen_prune_size = self.rival_gen_prune_size
         rgen_strategy = self._get_rival_gen_strategy(pass_no)
 
-        for tree_no in self.train_order:
+        for inst_no, tree_no in enumerate(self.train_order, start=1):
 
-            log_debug('TREE-NO: %d' % tree_no)
-            log_debug('SENT: %s' % self.train_sents[tree_no])
+            if is_debug_stream():
+                log_debug('TREE-NO: %d' % tree_no)
+                log_debug('SENT: %s' % self.train_sents[tree_no])
 
             gold = Inst(da=self.train_das[tree_no],
                         tree=self.train_trees[tree_no],
@@ -187,6 +258,8 @@ class BasePerceptronRanker(Ranker):
                 # check against other possible candidates/combinations
                 else:
                     gen = self._get_rival_candidates(gold, tree_no, strategy)
+                    if gen is None:  # no rivals available (single training instance)
+                        continue
 
                 # evaluate the top-scoring generated tree against gold t-tree
                 # (disregarding whether it was selected as the best one)
@@ -196,12 +269,19 @@ class BasePerceptronRanker(Ranker):
                 if gold.score < gen.score:
                     self._update_weights(gold, gen)
 
+            # apply the updates at the end of each mini-batch
+            if inst_no % self.batch_size == 0:
+                self.flush_weight_updates()
+
+        self.flush_weight_updates()
+
         # store a copy of the current weights for averaging
         self.store_iter_weights()
 
         # debug print: current weights and pass accuracy
-        log_debug(self._feat_val_str(), '\n***')
-        log_debug('PASS ACCURACY: %.3f' % self.evaluator.tree_accuracy())
+        if is_debug_stream():
+            log_debug(self._feat_val_str(), '\n***')
+            log_debug('PASS ACCURACY: %.3f' % self.evaluator.tree_accuracy())
 
         # print and return statistics
         self._print_pass_stats(pass_no, datetime.timedelta(seconds=(time.time() - pass_start_time)))
@@ -284,8 +364,9 @@ class BasePerceptronRanker(Ranker):
         TODO: checking for trees identical to the gold one slows down the process
 
         @param tree_no: the index of the current training data item (tree, DA)
-        @rtype: tuple of two lists: one of TreeData's, one of arrays
-        @return: an array of rival trees and an array of the corresponding features
+        @rtype: Inst
+        @return: the top-scoring rival candidate, or None if there are no other training \
+            instances to take rivals from
         """
         train_trees = self.train_trees
 
@@ -297,20 +378,18 @@ class BasePerceptronRanker(Ranker):
         # use current DA but change trees when computing features
         if strategy == 'other_inst':
             # use alternative indexes, avoid the correct one
-            rival_idxs = map(lambda idx: len(train_trees) - 1 if idx == tree_no else idx,
-                             rnd.sample(xrange(len(train_trees) - 1), self.rival_number))
+            rival_idxs = self._sample_rival_idxs(tree_no)
             other_inst_trees = [train_trees[rival_idx] for rival_idx in rival_idxs]
             rival_trees.extend(other_inst_trees)
-            rival_feats.extend([self._extract_feats(tree, gold.da) for tree in other_inst_trees])
+            rival_feats.extend([self._get_train_inst_feats(tree, gold.da) for tree in other_inst_trees])
 
         # use the current gold tree but change DAs when computing features
         if strategy == 'other_da':
-            rival_idxs = map(lambda idx: len(train_trees) - 1 if idx == tree_no else idx,
-                             rnd.sample(xrange(len(train_trees) - 1), self.rival_number))
+            rival_idxs = self._sample_rival_idxs(tree_no)
             other_inst_das = [self.train_das[rival_idx] for rival_idx in rival_idxs]
             rival_das.extend(other_inst_das)
-            rival_trees.extend([self.train_trees[tree_no]] * self.rival_number)
-            rival_feats.extend([self._extract_feats(self.train_trees[tree_no], da)
+            rival_trees.extend([self.train_trees[tree_no]] * len(rival_idxs))
+            rival_feats.extend([self._get_train_inst_feats(self.train_trees[tree_no], da)
                                 for da in other_inst_das])
 
 #         # candidates generated using the random planner (use the current DA)
@@ -323,23 +402,71 @@ class BasePerceptronRanker(Ranker):
 #             rival_trees.extend(random_trees)
 #             rival_feats.extend([self._extract_feats(tree, da) for tree in random_trees])
 
+        if not rival_feats:
+            return None
+
         # score them along with the right one
-        rival_scores = [self._score(r) for r in rival_feats]
-        top_rival_idx = rival_scores.index(max(rival_scores))
+        rival_scores = self._score_batch(rival_feats)
+        top_rival_idx = int(rival_scores.argmax())
         gen = Inst(tree=rival_trees[top_rival_idx],
                    da=rival_das[top_rival_idx],
                    score=rival_scores[top_rival_idx],
                    feats=rival_feats[top_rival_idx])
 
         # debug print: candidate trees
-        log_debug('#RIVALS: %02d' % len(rival_feats))
-        log_debug('SEL: GOLD' if gold.score >= gen.score else ('SEL: RIVAL#%d' % top_rival_idx))
-        log_debug('ALL CAND TREES:')
-        for ttree, score in zip([gold.tree] + rival_trees, [gold.score] + rival_scores):
-            log_debug("%12.5f" % score, "\t", ttree)
+        if is_debug_stream():
+            log_debug('#RIVALS: %02d' % len(rival_feats))
+            log_debug('SEL: GOLD' if gold.score >= gen.score else ('SEL: RIVAL#%d' % top_rival_idx))
+            log_debug('ALL CAND TREES:')
+            for ttree, score in zip([gold.tree] + rival_trees, [gold.score] + list(rival_scores)):
+                log_debug("%12.5f" % score, "\t", ttree)
 
         return gen
 
+    def _sample_rival_idxs(self, tree_no):
+        """Sample indexes of training instances to be used as rivals (at most self.rival_number
+        distinct indexes, all different from tree_no).
+
+        @param tree_no: the index of the current training data item (to be avoided)
+        @rtype: list
+        """
+        num_insts = len(self.train_trees)
+        num_rivals = min(self.rival_number, num_insts - 1)
+        # sample from all but the last index, use the last one in place of the current one
+        if 2 * num_rivals >= num_insts:
+            rival_idxs = rnd.sample(xrange(num_insts - 1), num_rivals)
+            return [num_insts - 1 if idx == tree_no else idx for idx in rival_idxs]
+        # few rivals out of many instances: draw indexes until we have enough distinct ones
+        rival_idxs = []
+        used_idxs = set([tree_no])
+        while len(rival_idxs) < num_rivals:
+            idx = int(rnd.random() * num_insts)
+            if idx not in used_idxs:
+                used_idxs.add(idx)
+                rival_idxs.append(idx)
+        return rival_idxs
+
+    def _get_train_inst_feats(self, tree, da):
+        """Return features for a training tree in the context of a training DA (not necessarily
+        from the same training instance). Since all training trees and DAs are kept throughout
+        the training, the features may be cached over passes, indexed by object identity, for
+        up to train_inst_feats_cache_size most recently used pairs. They bypass the general
+        feature cache, so that A*-search candidates are not pushed out of it.
+
+        @param tree: a training tree (from self.train_trees)
+        @param da: a training DA (from self.train_das)
+        """
+        if self.train_inst_feats_cache_size <= 0:
+            return self._extract_feats_nocache(tree, da)
+        key = (id(tree), id(da))
+        feats = self._train_inst_feats.pop(key, None)
+        if feats is None:
+            feats = self._extract_feats_nocache(tree, da)
+            if len(self._train_inst_feats) >= self.train_inst_feats_cache_size:
+                self._train_inst_feats.popitem(last=False)
+        self._train_inst_feats[key] = feats
+        return feats
+
     def _gen_cur_weights(self, gold, max_iter, max_defic_iter, prune_size, beam_size):
         """
         Get the best candidate generated using the A*search planner, which uses this ranker with current
@@ -377,15 +504,16 @@ class BasePerceptronRanker(Ranker):
         # scores are negative on the close list – reverse the sign
         gen = Inst(tree=gen_tree, da=gold.da, score=-gen_score,
                    feats=self._extract_feats(gen_tree, gold.da))
-        log_debug('SEL: GOLD' if gold.score >= gen.score else 'SEL: GEN')
-        log_debug("GOLD:\t", "%12.5f" % gold.score, "\t", gold.tree)
-        log_debug("GEN :\t", "%12.5f" % gen.score, "\t", gen.tree)
+        if is_debug_stream():
+            log_debug('SEL: GOLD' if gold.score >= gen.score else 'SEL: GEN')
+            log_debug("GOLD:\t", "%12.5f" % gold.score, "\t", gold.tree)
+            log_debug("GEN :\t", "%12.5f" % gen.score, "\t", gen.tree)
         return gen
 
     def _gen_update(self, gold, max_iter, max_defic_iter, prune_size, beam_size):
         """Try generating using the current weights, but update the weights after each
         iteration if the result is not going in the right direction (not a subtree of the
-        gold-standard tree).
+        gold-standard tree). These updates are applied immediately, regardless of batch_size.
 
         @param gold: the gold-standard Inst holding the input DA for generation and the reference tree
         @param max_iter: maximum number of A*-search iterations to run
@@ -437,6 +565,10 @@ class BasePerceptronRanker(Ranker):
                 else:
                     self._update_weights(gold, gen)
 
+                # the search continues with the updated weights, so apply the updates right away
+                # (even with mini-batches)
+                self.flush_weight_updates()
+
         return self.get_best_generated(gold)
 
     def get_weights(self):
@@ -452,6 +584,11 @@ class BasePerceptronRanker(Ranker):
         To be overridden by derived classes."""
         raise NotImplementedError
 
+    def flush_weight_updates(self):
+        """Apply weight updates accumulated over a mini-batch. To be overridden by derived
+        classes that support mini-batch updates; all updates are applied immediately otherwise."""
+        pass
+
     def store_iter_weights(self):
         """Remember the current weights to be used for averaging.
         To be overridden by derived classes."""
@@ -521,38 +658,156 @@ class FeaturesPerceptronRanker(BasePerceptronRanker):
         self.vectorizer = None
         self.normalizer = None
         self.binarize = cfg.get('binarize', False)
+        # single precision halves the memory footprint and bandwidth of features & weights
+        self.feats_dtype = np.dtype(cfg.get('feats_dtype', 'float32'))
+        # number of processes used to extract training data features
+        self.feats_workers = cfg.get('feats_workers', 1)
+        # LRU cache for features of (tree, DA) pairs, which may be scored repeatedly in training;
+        # its size is the number of cached feature vectors (0 = no caching, the default), memory
+        # use is therefore feats_cache_size x number of features x 4 bytes (for float32)
+        self.feats_cache_size = cfg.get('feats_cache_size', 0)
+        self._feats_cache = OrderedDict()
         # initialize feature functions
         if 'features' in cfg:
             self.feats.extend(cfg['features'])
         self.feats = Features(self.feats, cfg.get('intermediate_features', []))
 
+    def __setstate__(self, state):
+        """Backward compatibility – adding members missing in older versions."""
+        if 'feats_cache_size' not in state:
+            state['feats_cache_size'] = 0
+        if 'feats_dtype' not in state:
+            state['feats_dtype'] = np.dtype('float64')
+        if '_feats_cache' not in state:
+            state['_feats_cache'] = OrderedDict()
+        self.__dict__ = state
+
     def _extract_feats(self, tree, da):
-        feats = self.vectorizer.transform([self.feats.get_features(tree, {'da': da})])
+        """Return the (vectorized and normalized) features for the given tree and DA.
+        Features are cached for the most recently used (tree, DA) pairs (see _feats_cache_key).
+
+        The returned array must not be modified in place.
+        """
+        if self.feats_cache_size <= 0:
+            return self._vectorize_feats([tree], da)[0]
+        key = self._feats_cache_key(tree, da)
+        feats = self._feats_cache.pop(key, None)
+        if feats is None:
+            feats = self._vectorize_feats([tree], da)[0]
+        self._cache_feats(key, feats)
+        return feats
+
+    def _extract_feats_batch(self, trees, da):
+        """Return features for all the given trees in the context of the given DA. Features
+        not found in the cache are vectorized and normalized all at once.
+
+        @rtype: np.ndarray
+        @return: a 2-D array with features for each tree as rows
+        """
+        if self.feats_cache_size <= 0:
+            return self._vectorize_feats(trees, da)
+        keys = [self._feats_cache_key(tree, da) for tree in trees]
+        feats = [self._feats_cache.pop(key, None) for key in keys]
+        missing = [idx for idx, tree_feats in enumerate(feats) if tree_feats is None]
+        if len(missing) == len(trees):  # nothing cached, no need to stack the rows again
+            feats = self._vectorize_feats(trees, da)
+        elif missing:
+            new_feats = self._vectorize_feats([trees[idx] for idx in missing], da)
+            for idx, tree_feats in zip(missing, new_feats):
+                feats[idx] = tree_feats
+        for key, tree_feats in zip(keys, feats):
+            self._cache_feats(key, tree_feats)
+        return np.asarray(feats)
+
+    def _extract_feats_nocache(self, tree, da):
+        """Return features for the given tree and DA without using the LRU cache."""
+        return self._vectorize_feats([tree], da)[0]
+
+    def _vectorize_feats(self, trees, da):
+        """Extract, vectorize, and normalize features for all the given trees in the context
+        of the given DA (without using the cache).
+
+        @rtype: np.ndarray
+        @return: a 2-D array with features for each tree as rows
+        """
+        feats = self.vectorizer.transform([self.feats.get_features(tree, {'da': da})
+                                           for tree in trees])
         if self.normalizer:
             feats = self.normalizer.transform(feats)
-        return feats[0]
+        return feats
+
+    def _feats_cache_key(self, tree, da):
+        """Return the feature cache key for the given tree and DA. This is an immutable copy of
+        their contents, so that trees (or DAs) modified in place after scoring do not corrupt
+        the cache."""
+        return tuple(tree.nodes), tuple(tree.parents), repr(da)
+
+    def _cache_feats(self, key, feats):
+        """Store features in the cache as the most recently used entry, dropping the least
+        recently used one if the cache is full. Rows of larger arrays are copied, so that the
+        cache does not keep whole batches of features alive."""
+        if len(self._feats_cache) >= self.feats_cache_size:
+            self._feats_cache.popitem(last=False)
+        if feats.base is not None:
+            feats = np.array(feats)
+        self._feats_cache[key] = feats
+
+    def score_all(self, cand_trees, da):
+        """Array version of the score() function, extracting and scoring features in batches."""
+        return self._score_batch(self._extract_feats_batch(cand_trees, da))
 
     def _init_training(self, das_file, ttree_file, data_portion):
 
         super(FeaturesPerceptronRanker, self)._init_training(das_file, ttree_file, data_portion)
 
         # precompute training data features
-        X = []
-        for da, tree in zip(self.train_das, self.train_trees):
-            X.append(self.feats.get_features(tree, {'da': da}))
+        X = self._get_train_feats_dicts()
         if self.prune_feats > 1:
             self._prune_features(X)
         # vectorize and binarize or normalize (+train vectorizer/normalizer)
         if self.binarize:
-            self.vectorizer = DictVectorizer(sparse=False, binarize_numeric=True)
+            self.vectorizer = DictVectorizer(dtype=self.feats_dtype.type, sparse=False,
+                                             binarize_numeric=True)
             self.train_feats = self.vectorizer.fit_transform(X)
         else:
-            self.vectorizer = DictVectorizer(sparse=False)
+            self.vectorizer = DictVectorizer(dtype=self.feats_dtype.type, sparse=False)
             self.normalizer = StandardScaler(copy=False)
             self.train_feats = self.normalizer.fit_transform(self.vectorizer.fit_transform(X))
+        # cached features are invalid with the newly trained vectorizer/normalizer
+        self._feats_cache.clear()
 
         log_info('Features matrix shape: %s' % str(self.train_feats.shape))
 
+    def _get_train_feats_dicts(self):
+        """Extract (unvectorized) features for all training instances, possibly using multiple
+        worker processes (if set in the configuration).
+
+        Features are only extracted once for repeated (tree, DA) pairs; the repeated instances
+        then share the same dictionary.
+
+        @rtype: list
+        @return: a list of feature dictionaries, one for each training instance
+        """
+        uniq_idxs = {}
+        inst_idxs = []
+        for inst in zip(self.train_trees, self.train_das):
+            inst_idxs.append(uniq_idxs.setdefault(inst, len(uniq_idxs)))
+        insts = sorted(uniq_idxs, key=uniq_idxs.get)
+
+        if self.feats_workers <= 1:
+            X = [self.feats.get_features(tree, {'da': da}) for tree, da in insts]
+        else:
+            log_info('Extracting features using %d processes...' % self.feats_workers)
+            pool = multiprocessing.Pool(self.feats_workers, _init_feats_worker, (self.feats,))
+            try:
+                chunksize = max(1, len(insts) // (4 * self.feats_workers))
+                X = pool.map(_get_inst_feats, insts, chunksize)
+            finally:
+                pool.close()
+                pool.join()
+
+        return [X[inst_idx] for inst_idx in inst_idxs]
+
     def _prune_features(self, X):
         """Prune features – remove all entries from X that involve features not having a
         specified minimum occurrence count.
@@ -572,9 +827,15 @@ class PerceptronRanker(FeaturesPerceptronRanker):
 
     def __init__(self, cfg):
         super(PerceptronRanker, self).__init__(cfg)
-        self.w_after_iter = []
+        if not cfg:
+            cfg = {}
+        # running sum & count of weights after each pass, for averaging
+        self.w_iter_sum = None
+        self.w_iter_count = 0
         self.w = None
         self.w_sum = 0.0
+        # store weights in saved models as 8-bit integers (+ scaling factor)
+        self.quantize_weights = cfg.get('quantize_weights', False)
 
     def __setstate__(self, state):
         """Backward compatibility – adding members missing in older versions."""
@@ -583,13 +844,35 @@ class PerceptronRanker(FeaturesPerceptronRanker):
             state['normalizer'] = None
         if 'binarize' not in state:
             state['binarize'] = False
-        self.__dict__ = state
+        if 'batch_size' not in state:
+            state['batch_size'] = 1
+        if 'train_inst_feats_cache_size' not in state:
+            state['train_inst_feats_cache_size'] = 0
+        if 'quantize_weights' not in state:
+            state['quantize_weights'] = False
+        super(PerceptronRanker, self).__setstate__(state)
+        # restore quantized weights
+        if 'w_scale' in state:
+            self.w = (self.w / self.__dict__.pop('w_scale')).astype(self.feats_dtype)
+
+    def _get_model_to_save(self):
+        """Return a copy of the ranker to be saved, with quantized weights if set up to do so."""
+        model = super(PerceptronRanker, self)._get_model_to_save()
+        if self.quantize_weights:
+            w_max = np.abs(self.w).max()
+            model.w_scale = 127.0 / w_max if w_max > 0 else 1.0
+            model.w = np.round(self.w * model.w_scale).astype(np.int8)
+        return model
 
     def _init_training(self, das_file, ttree_file, data_portion):
         # load data, determine number of features etc. etc.
         super(PerceptronRanker, self)._init_training(das_file, ttree_file, data_portion)
         # initialize weights
-        self.w = np.ones(self.train_feats.shape[1])
+        self.w = np.ones(self.train_feats.shape[1], dtype=self.train_feats.dtype)
+        # weight updates accumulated over the current mini-batch
+        self._w_delta = np.zeros_like(self.w)
+        # buffer for computing weight updates without temporary arrays
+        self._diff_buf = np.empty_like(self.w)
         self.update_weights_sum()
         # self.w = np.array([rnd.gauss(0, self.alpha) for _ in xrange(self.train_feats.shape[1])])
 
@@ -600,9 +883,15 @@ class PerceptronRanker(FeaturesPerceptronRanker):
     def _score(self, cand_feats):
         return np.dot(self.w, cand_feats)
 
+    def _score_batch(self, cands_feats):
+        """Score all candidates using a single matrix-vector product."""
+        return np.dot(cands_feats, self.w)
+
     def _update_weights(self, good, bad):
         """Perform a perceptron weights update (not the check if we need to update).
-        Also perform differing tree updates."""
+        Also perform differing tree updates. If mini-batch training is set up, the update
+        is only accumulated, to be applied in flush_weight_updates()."""
+        w = self._w_delta if self.batch_size > 1 else self.w
         # discount trees leading to the generated one and add trees leading to the gold one
         if self.diffing_trees:
             good_sts, bad_sts = good.tree.diffing_trees(bad.tree,
@@ -615,11 +904,11 @@ class PerceptronRanker(FeaturesPerceptronRanker):
             for good_st in good_sts:
                 good_feats = self._extract_feats(good_st, good.da)
                 if discount is not None:
-                    good_feats -= discount
+                    good_feats = good_feats - discount
                 good_tree_w = 1
                 if self.diffing_trees.endswith('weighted'):
                     good_tree_w = len(good_st) / float(len(good.tree))
-                self.w += self.alpha * good_tree_w * good_feats
+                w += self.alpha * good_tree_w * good_feats
             # discount bad trees (leading to the generated one)
             if 'nobad' in self.diffing_trees:
                 bad_sts = []
@@ -628,16 +917,24 @@ class PerceptronRanker(FeaturesPerceptronRanker):
             for bad_st in bad_sts:
                 bad_feats = self._extract_feats(bad_st, bad.da)
                 if discount is not None:
-                    bad_feats -= discount
+                    bad_feats = bad_feats - discount
                 bad_tree_w = 1
                 if self.diffing_trees.endswith('weighted'):
                     bad_tree_w = len(bad_st) / float(len(bad.tree))
-                self.w -= self.alpha * bad_tree_w * bad_feats
+                w -= self.alpha * bad_tree_w * bad_feats
         # just discount the best generated tree and add the gold tree
         else:
-            self.w += (self.alpha * good.feats - self.alpha * bad.feats)
+            diff = np.subtract(good.feats, bad.feats, out=self._diff_buf)
+            diff *= self.alpha
+            w += diff
         # # log_debug('Updated  w: ' + str(np.frombuffer(self.w, "uint8").sum()))
 
+    def flush_weight_updates(self):
+        """Apply the weight updates accumulated over the current mini-batch."""
+        if self.batch_size > 1:
+            self.w += self._w_delta
+            self._w_delta.fill(0)
+
     def _feat_val_str(self, sep='\n', nonzero=False):
         return ''
 
@@ -646,20 +943,24 @@ class PerceptronRanker(FeaturesPerceptronRanker):
         return self.w
 
     def set_weights(self, w):
-        """Set new perceptron ranker weights."""
-        self.w = w
+        """Set new perceptron ranker weights (keeping them in the same precision as features,
+        so that scoring does not need any conversions)."""
+        self.w = np.ascontiguousarray(w, dtype=self.feats_dtype)
 
     def set_weights_average(self, ws):
         """Set the weights as the average of the given array of weights (used in parallel training)."""
-        self.w = np.average(ws, axis=0)
+        self.w = np.average(ws, axis=0).astype(self.feats_dtype)
 
     def store_iter_weights(self):
         """Remember the current weights to be used for averaged perceptron."""
-        self.w_after_iter.append(np.copy(self.w))
+        if self.w_iter_sum is None:
+            self.w_iter_sum = np.zeros(self.w.shape, dtype=np.float64)
+        self.w_iter_sum += self.w
+        self.w_iter_count += 1
 
     def set_weights_iter_average(self):
         """Average the remembered weights."""
-        self.w = np.average(self.w_after_iter, axis=0)
+        self.w = (self.w_iter_sum / self.w_iter_count).astype(self.feats_dtype)
 
     def get_weights_sum(self):
         """Return the sum of weights (at start of current iteration) to be used to weigh future
@@ -668,4 +969,4 @@ class PerceptronRanker(FeaturesPerceptronRanker):
 
     def update_weights_sum(self):
         """Update the current weights sum figure."""
-        self.w_sum = sum(self.w)
+        self.w_sum = self.w.sum()